@@ -1,5 +1,23 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+from contextlib import nullcontext
+from torch.nn.attention import SDPBackend, sdpa_kernel
+
+# Fused attention kernels allowed on GPU (no fallback to the unfused math path
+# unless head_dim is not aligned for them, see SelfAttention)
+FUSED_SDPA_BACKENDS = [SDPBackend.FLASH_ATTENTION, SDPBackend.EFFICIENT_ATTENTION]
+
+def add_norm_dropout(x, residual, norm, dropout):
+    # Residual add, layer normalization and dropout, fused into one kernel
+    # when the stacks are compiled (Transformer(use_compile=True))
+    return dropout(norm(x + residual))
+
+def embed_dropout(x, positions, word_embedding, position_embedding, dropout, scale):
+    # Word and position gathers, their sum and dropout, fused into one kernel
+    # when the stacks are compiled. Word embeddings are multiplied by
+    # sqrt(embed_size) as in the paper (section 3.4)
+    return dropout(word_embedding(x) * scale + position_embedding(positions))
 
 class SelfAttention(nn.Module):
     def __init__(self, embed_size, heads):
@@ -13,15 +31,22 @@ class SelfAttention(nn.Module):
         # Assert to check embed size can be properly divided
         assert (self.head_dim * heads == embed_size), "Embed size needs to be div by heads"
         
-        # Linear layers for projections
-        self.values = nn.Linear(self.head_dim, self.head_dim, bias=False) 
-        self.keys = nn.Linear(self.head_dim, self.head_dim, bias=False)
-        self.queries = nn.Linear(self.head_dim, self.head_dim, bias=False)
+        # Attention scale 1/sqrt(head_dim), applied inside the SDPA kernel
+        self.scale = self.head_dim ** -0.5
+        
+        # Flash and memory-efficient kernels need head_dim to be a multiple of 8
+        # (FP16/BF16), otherwise allow the math kernel so GPU forwards still run
+        self.sdpa_backends = list(FUSED_SDPA_BACKENDS)
+        if self.head_dim % 8 != 0:
+            self.sdpa_backends.append(SDPBackend.MATH)
+        
+        # Single fused linear layer for query, key and value projections
+        self.qkv = nn.Linear(embed_size, 3*embed_size, bias=False)
         
         # Output linear layer
         self.fc_out = nn.Linear(heads*self.head_dim, embed_size) 
         
-    def forward(self, values, keys, query, mask):
+    def forward(self, values, keys, query, mask, is_causal=False, self_attention=False):
         
         # Number of training examples
         N = query.shape[0]  
@@ -29,37 +54,59 @@ class SelfAttention(nn.Module):
         # Length of sequences 
         value_len, key_len, query_len = values.shape[1], keys.shape[1], query.shape[1] 
         
-        # Split the embedding into self.heads pieces
-        values = values.reshape(N, value_len, self.heads, self.head_dim)
-        keys = keys.reshape(N, key_len, self.heads, self.head_dim)
-        queries = query.reshape(N, query_len, self.heads, self.head_dim)
-        
-        # Pass linear layers 
-        values = self.values(values)
-        keys = self.keys(keys)
-        query = self.queries(queries)
-        
-        # Einsum does matrix mult. for query*keys for each training example
-        # with every other seq. from keys, with each head
-        energy = torch.einsum("nqhd,nkhd->nhqk", [queries, keys])
-        # queries shape: (N, query_len, heads, heads_dim)
-        # keys shape: (N, key_len, heads, heads_dim)
-        # energy: (N, heads, query_len, key_len)
-        
-        # Mask out based on source sentence lengths  
+        # Pass linear layers on the full embedding, then split heads straight
+        # into (N, heads, seq_len, head_dim), the layout SDPA and batched GEMMs use
+        if self_attention:
+            # Self-attention, values/keys alias query so project it once
+            qkv = self.qkv(query)
+            queries, keys, values = qkv.reshape(
+                N, query_len, 3, self.heads, self.head_dim
+            ).permute(2, 0, 3, 1, 4).unbind(dim=0)
+        else:
+            # Cross-attention, Q from query and K/V from the encoder output
+            q_weight, kv_weight = self.qkv.weight.split(
+                [self.embed_size, 2*self.embed_size]
+            )
+            queries = F.linear(query, q_weight).reshape(
+                N, query_len, self.heads, self.head_dim
+            ).transpose(1, 2)
+            if keys is values:
+                # One GEMM for K and V
+                kv = F.linear(keys, kv_weight)
+                keys, values = kv.reshape(
+                    N, key_len, 2, self.heads, self.head_dim
+                ).permute(2, 0, 3, 1, 4).unbind(dim=0)
+            else:
+                k_weight, v_weight = kv_weight.chunk(2)
+                keys = F.linear(keys, k_weight).reshape(
+                    N, key_len, self.heads, self.head_dim
+                ).transpose(1, 2)
+                values = F.linear(values, v_weight).reshape(
+                    N, value_len, self.heads, self.head_dim
+                ).transpose(1, 2)
+        # queries shape: (N, heads, query_len, heads_dim)
+        # keys shape: (N, heads, key_len, heads_dim)
+        # values shape: (N, heads, value_len, heads_dim)
+        
+        # Additive mask (0 keep, -inf drop) in the dtype of Q, e.g. BF16 under autocast
         if mask is not None:
-            energy = energy.masked_fill(mask == 0, float("-1e20"))  
-
-        # Softmax applied on last dim  
-        attention = torch.softmax(energy / (self.embed_size ** (1/2)), dim=3)
-                
-        # Multiply attention by V
-        out = torch.einsum("nhql,nlhd->nqhd", [attention, values]).reshape(
-            N, query_len, self.heads*self.head_dim
-        )
-        # attention shape: (N, heads, query_len, key_len)
-        # values shape: (N, value_len, heads, heads_dim)  
-        # after einsum (N, query_len, heads, head_dim) then flatten last two dimensions
+            mask = mask.to(queries.dtype)
+        
+        # Fused scaled dot-product attention, meant to avoid materializing the
+        # (N, heads, query_len, key_len) energy matrix. FlashAttention accepts
+        # no attn_mask and needs FP16/BF16 Q/K/V, so at most the causal decoder
+        # self-attention is eligible for it and masked calls are left to the
+        # memory-efficient kernel (backend choice not profiled on GPU). The
+        # scale stays a Python float so it does not promote Q/K/V to FP32
+        context = sdpa_kernel(self.sdpa_backends) if queries.is_cuda else nullcontext()
+        with context:
+            out = F.scaled_dot_product_attention(
+                queries, keys, values, attn_mask=mask, dropout_p=0.0,
+                is_causal=is_causal, scale=self.scale
+            )
+        
+        # Back to (N, query_len, heads, head_dim) then flatten last two dimensions
+        out = out.transpose(1, 2).reshape(N, query_len, self.heads*self.head_dim)
         
         # Output linear layer
         out = self.fc_out(out)
@@ -80,22 +127,33 @@ class TransformerBlock(nn.Module):
             nn.Linear(forward_expansion*embed_size, embed_size),
         )
         
-        self.dropout = nn.Dropout(dropout) # Dropout
+        self.dropout = nn.Dropout(dropout) if dropout > 0 else nn.Identity() # Dropout
         
-    def forward(self, value, key, query, mask):
+    def forward(self, value, key, query, mask, self_attention=False):
         
         # Attention 
-        attention = self.attention(value, key, query, mask)
+        attention = self.attention(
+            value, key, query, mask, self_attention=self_attention
+        )
         
         # Residual connection + layer normalization
-        x = self.norm1(attention + query)  
-        x = self.dropout(x)
+        x = add_norm_dropout(attention, query, self.norm1, self.dropout)
         
         # Feed forward network 
         forward = self.feed_forward(x)
-        out = self.dropout(self.norm2(forward + x))
+        out = add_norm_dropout(forward, x, self.norm2, self.dropout)
         return out
 
+class EncoderBlock(TransformerBlock):
+    def forward(self, inputs):
+        
+        # Single (x, mask) input so blocks can be chained in nn.Sequential
+        x, mask = inputs
+        
+        # Self-attention, x is used for values, keys and query
+        out = super(EncoderBlock, self).forward(x, x, x, mask, self_attention=True)
+        return out, mask
+
 class Encoder(nn.Module):
     def __init__(
         self, 
@@ -103,7 +161,6 @@ class Encoder(nn.Module):
         embed_size,
         num_layers,
         heads,
-        device,
         forward_expansion,
         dropout,
         max_length,
@@ -111,15 +168,26 @@ class Encoder(nn.Module):
     
         super(Encoder, self).__init__()
         self.embed_size = embed_size
-        self.device = device
         
-        # Embedding Layer
+        # Embedding Layer, word table initialized like the decoder's tied one
         self.word_embedding = nn.Embedding(src_vocab_size, embed_size)
         self.position_embedding = nn.Embedding(max_length, embed_size)
+        nn.init.normal_(self.word_embedding.weight, mean=0.0, std=embed_size ** -0.5)
+        
+        # Word embeddings are scaled back to unit std, on par with positions
+        self.embed_scale = embed_size ** 0.5
+        
+        # Position indices kept on the model's device, sliced on each forward
+        # (int32 halves the index traffic of the embedding gather)
+        self.register_buffer(
+            "positions",
+            torch.arange(0, max_length, dtype=torch.int32).unsqueeze(0),
+            persistent=False
+        )
 
-        # Transformer Blocks
-        self.layers = nn.ModuleList(
-            [TransformerBlock(
+        # Transformer Blocks, chained as one traceable container
+        self.layers = nn.Sequential(
+            *[EncoderBlock(
                 embed_size,
                 heads,
                 dropout=dropout,
@@ -127,38 +195,41 @@ class Encoder(nn.Module):
             ) for _ in range(num_layers)]
         )
         
-        self.dropout = nn.Dropout(dropout)
+        self.dropout = nn.Dropout(dropout) if dropout > 0 else nn.Identity()
         
     def forward(self, x, mask):
         
-        # Get seq length and batch size
-        N, seq_length = x.shape[0], x.shape[1]  
+        # Get seq length
+        seq_length = x.shape[1]
         
         # Generate positional encodings
-        positions = torch.arange(0, seq_length).expand(N, seq_length).to(self.device)   
+        positions = self.positions[:, :seq_length]
         
         # Embed input words 
-        out = self.dropout(self.word_embedding(x) + self.position_embedding(positions))
+        out = embed_dropout(
+            x, positions, self.word_embedding, self.position_embedding,
+            self.dropout, self.embed_scale
+        )
 
         # Pass through encoder layers 
-        for layer in self.layers:
-            out = layer(out, out, out, mask)
+        out, _ = self.layers((out, mask))
         
         return out
         
 class DecoderBlock(nn.Module):
-    def __init__(self, embed_size, heads, forward_expansion, dropout, device):
+    def __init__(self, embed_size, heads, forward_expansion, dropout):
         super(DecoderBlock, self).__init__()
         self.attention = SelfAttention(embed_size,heads)
         self.norm = nn.LayerNorm(embed_size)
         self.transformer_block = TransformerBlock(
             embed_size, heads, dropout, forward_expansion
         )
-        self.dropout = nn.Dropout(dropout)
+        self.dropout = nn.Dropout(dropout) if dropout > 0 else nn.Identity()
         
-    def forward(self, x, value, key, src_mask, trg_mask):
-        attention = self.attention(x, x, x, trg_mask)
-        query = self.dropout(self.norm(attention + x))
+    def forward(self, x, value, key, src_mask):
+        # Masked self-attention, causal masking is applied inside the kernel
+        attention = self.attention(x, x, x, None, is_causal=True, self_attention=True)
+        query = add_norm_dropout(attention, x, self.norm, self.dropout)
         out = self.transformer_block(value, key, query, src_mask)
         return out
 
@@ -171,45 +242,65 @@ class Decoder(nn.Module):
         heads,
         forward_expansion,
         dropout,
-        device,
         max_length,
         ):
     
         super(Decoder, self).__init__()
-        self.device = device
         
         # Embedding Layer
         self.word_embedding = nn.Embedding(trg_vocab_size, embed_size)
         self.position_embedding = nn.Embedding(max_length, embed_size)
+        
+        # Position indices kept on the model's device, sliced on each forward
+        # (int32 halves the index traffic of the embedding gather)
+        self.register_buffer(
+            "positions",
+            torch.arange(0, max_length, dtype=torch.int32).unsqueeze(0),
+            persistent=False
+        )
 
         # Transformer Blocks
         self.layers = nn.ModuleList(
-            [DecoderBlock(embed_size, heads, forward_expansion, dropout, device)
+            [DecoderBlock(embed_size, heads, forward_expansion, dropout)
             for _ in range(num_layers)]
         )
         
         # Fully Connected Layer
         self.fc_out = nn.Linear(embed_size, trg_vocab_size)
         
-        self.dropout = nn.Dropout(dropout)
+        # Tie output projection to the target embedding table, initialized
+        # with std 1/sqrt(embed_size) so initial logits stay O(1) instead of
+        # the N(0, 1) embedding default saturating the softmax
+        self.fc_out.weight = self.word_embedding.weight
+        nn.init.normal_(self.word_embedding.weight, mean=0.0, std=embed_size ** -0.5)
+        
+        # The lookup is scaled back up so tokens are on par with positions,
+        # and the decoder output scaled down by the same factor before the
+        # tied projection so the logits match the table's 1/sqrt(embed_size)
+        self.embed_scale = embed_size ** 0.5
+        
+        self.dropout = nn.Dropout(dropout) if dropout > 0 else nn.Identity()
         
-    def forward(self, x, enc_out, src_mask, trg_mask):
+    def forward(self, x, enc_out, src_mask):
         
-        # Get seq length and batch size
-        N, seq_length = x.shape[0], x.shape[1]  
+        # Get seq length
+        seq_length = x.shape[1]
         
         # Generate positional encodings
-        positions = torch.arange(0, seq_length).expand(N, seq_length).to(self.device)
+        positions = self.positions[:, :seq_length]
         
         # Embed input words and add positional encoding
-        x = self.dropout((self.word_embedding(x) + self.position_embedding(positions)))
+        x = embed_dropout(
+            x, positions, self.word_embedding, self.position_embedding,
+            self.dropout, self.embed_scale
+        )
 
         # Pass through decoder layers
         for layer in self.layers:
-            x = layer(x, enc_out, enc_out, src_mask, trg_mask)
+            x = layer(x, enc_out, enc_out, src_mask)
         
         # Output layer 
-        out = self.fc_out(x)
+        out = self.fc_out(x / self.embed_scale)
         
         return out
 
@@ -225,8 +316,8 @@ class Transformer(nn.Module):
         forward_expansion=4,
         heads=8,
         dropout=0,
-        device="cuda",
-        max_length=100
+        max_length=100,
+        use_compile=False
     ):
     
         super(Transformer, self).__init__()
@@ -237,7 +328,6 @@ class Transformer(nn.Module):
             embed_size,
             num_layers,
             heads,
-            device,
             forward_expansion,
             dropout,
             max_length
@@ -251,48 +341,126 @@ class Transformer(nn.Module):
             heads, 
             forward_expansion,
             dropout,
-            device,
             max_length
         )
         
+        # Optionally compile each stack as one graph so Inductor can fuse across
+        # layers, in place so parameter names in the state dict stay unchanged.
+        # Shapes are left to dynamo, which marks batch and sequence length
+        # dynamic after the first recompile instead of specializing on each
+        if use_compile:
+            self.encoder.compile(fullgraph=True)
+            self.decoder.compile(fullgraph=True)
+        
         self.src_pad_idx = src_pad_idx
         self.trg_pad_idx = trg_pad_idx  
-        self.device = device
         
     def make_src_mask(self, src):
         
-        # Source padding mask
-        src_mask = (src != self.src_pad_idx).unsqueeze(1).unsqueeze(2)
+        # Source padding mask, added to the attention scores inside SDPA
+        src_mask = torch.where(src == self.src_pad_idx, float("-inf"), 0.0)
+        src_mask = src_mask.unsqueeze(1).unsqueeze(2)
         # (N, 1, 1, src_len)
         
-        return src_mask.to(self.device)
+        return src_mask
     
-    def make_trg_mask(self, trg):
-        
-        # Target padding mask
-        N, trg_len = trg.shape
-        trg_mask = torch.tril(torch.ones((trg_len, trg_len))).expand(
-            N, 1, trg_len, trg_len
-        )
-        
-        return trg_mask.to(self.device)
-        
     def forward(self, src, trg):
               
         # Source mask        
         src_mask = self.make_src_mask(src)
         
-        # Target mask
-        trg_mask = self.make_trg_mask(trg)
-        
         # Pass through encoder
         enc_src = self.encoder(src, src_mask)
         
         # Pass through decoder  
-        out = self.decoder(trg, enc_src, src_mask, trg_mask)
+        out = self.decoder(trg, enc_src, src_mask)
              
         return out
 
+class QuantizedEmbedding(nn.Module):
+    def __init__(self, weight_int8, scale):
+        super(QuantizedEmbedding, self).__init__()
+        
+        # Int8 table with one float scale per row, inference only
+        self.register_buffer("weight_int8", weight_int8)
+        self.register_buffer("scale", scale)
+        
+    @classmethod
+    def from_float(cls, embedding):
+        
+        # Symmetric per-row quantization, largest magnitude in each row maps to 127
+        weight = embedding.weight.detach().float()
+        scale = weight.abs().amax(dim=1).clamp(min=1e-8) / 127
+        weight_int8 = torch.round(weight / scale.unsqueeze(1)).clamp(-127, 127)
+        
+        return cls(weight_int8.to(torch.int8), scale)
+        
+    def forward(self, x):
+        
+        # Gather a quarter of the bytes of an FP32 table, then dequantize the rows
+        out = self.weight_int8[x].to(self.scale.dtype) * self.scale[x].unsqueeze(-1)
+        return out
+
+def capture_cuda_graph(model, src, trg, warmup_steps=3):
+    
+    # Opt-in helper, not used by the demo and not yet run on a GPU. Compare
+    # replayed output against an eager forward before relying on it
+    
+    # Capture under autocast only with cache_enabled=False, cached casts
+    # made during warmup would otherwise be freed behind the graph's back
+    
+    # Static input buffers, new batches are copied in before each replay
+    static_src, static_trg = src.clone(), trg.clone()
+    
+    with torch.inference_mode():
+        # Warm up on a side stream so lazy init and compilation are not captured
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(warmup_steps):
+                model(static_src, static_trg)
+        torch.cuda.current_stream().wait_stream(stream)
+        
+        # Record every kernel of one forward pass into a single graph
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph):
+            static_out = model(static_src, static_trg)
+    
+    def forward(src, trg):
+        # Shapes must match the captured ones, use
+        # torch.compile(model, mode="reduce-overhead") for varying shapes
+        static_src.copy_(src)
+        static_trg.copy_(trg)
+        graph.replay()
+        # Every replay writes into the same static_out buffer, return a copy
+        # so results held by the caller are not overwritten by the next call
+        return static_out.clone()
+    
+    return forward
+
+def quantize_dynamic_linears(model):
+    
+    # Int8 weights for the FFN linears and the vocabulary projection, which
+    # hold most of the parameters. Attention stays in floating point so no
+    # reformat kernels are added around SDPA. Dynamic quantization runs on CPU
+    names = {
+        name for name, module in model.named_modules()
+        if isinstance(module, nn.Linear)
+        and (".feed_forward." in name or name == "decoder.fc_out")
+    }
+    
+    # Activations are quantized on the fly for each call
+    return torch.ao.quantization.quantize_dynamic(model, names, dtype=torch.qint8)
+
+def quantize_embeddings(model):
+    
+    # Swap the word embedding tables for int8 ones in place. The decoder's
+    # tied fc_out keeps the float table unless it is quantized as well
+    for stack in (model.encoder, model.decoder):
+        stack.word_embedding = QuantizedEmbedding.from_float(stack.word_embedding)
+    
+    return model
+
 if __name__ == "__main__":
     
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -308,7 +476,16 @@ if __name__ == "__main__":
     
     model = Transformer(src_vocab_size, trg_vocab_size, src_pad_idx, trg_pad_idx).to(device)
     
-    #Inference
-    out = model(x, trg[:, :-1]) 
+    #Inference in BF16, which makes the unmasked causal self-attention
+    #eligible for FlashAttention on GPU
+    with torch.autocast(device_type=device.type, dtype=torch.bfloat16):
+        out = model(x, trg[:, :-1]) 
+    
+    print(out.shape)
+    
+    #Inference with int8 FFN, output linears and word embeddings on CPU
+    quantized_model = quantize_embeddings(quantize_dynamic_linears(model.cpu().eval()))
+    with torch.inference_mode():
+        out = quantized_model(x.cpu(), trg[:, :-1].cpu())
     
     print(out.shape)